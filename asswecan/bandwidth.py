@@ -0,0 +1,194 @@
+import itertools
+import threading
+import time
+from typing import Dict, Optional
+
+PRIORITY_BULK = 1.0
+PRIORITY_INTERACTIVE = 8.0
+
+
+class TokenBucket:
+    def __init__(self, rate: Optional[float] = None, burst: float = 1.0):
+        """`rate` is in bytes per second, None for unlimited; the bucket holds `burst` seconds of it."""
+        self._rate = rate
+        self._burst = burst
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: Optional[float]):
+        self._refill()
+        self._rate = rate
+        self._tokens = min(self._tokens, self.capacity)
+
+    @property
+    def capacity(self) -> float:
+        return float('inf') if self._rate is None else self._rate * self._burst
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def ready(self, n: int) -> bool:
+        self._refill()
+        return self._rate is None or self._tokens >= min(n, self.capacity)
+
+    def delay(self, n: int) -> float:
+        """Seconds until `n` bytes may pass."""
+        if self.ready(n):
+            return 0
+        return (min(n, self.capacity) - self._tokens) / self._rate
+
+    @property
+    def full(self) -> bool:
+        """A full bucket behaves exactly like a new one."""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def consume(self, n: int):
+        # a chunk larger than the bucket leaves it in debt, so the average rate still holds
+        if self._rate is not None:
+            self._tokens -= n
+
+
+class BandwidthScheduler:
+    """Shares a global and per-host byte rate between concurrent transfers.
+
+    Waiting transfers are granted in weighted fair order: a transfer with weight 8 is served
+    about 8 times as often as one with weight 1 while both wait on the same bucket.
+    """
+
+    _POLL = 0.05
+    # seconds between sweeps of idle per-host buckets
+    _SWEEP = 10.0
+
+    def __init__(self, rate: float = None, host_rates: Dict[str, float] = None, burst: float = 1.0):
+        self._cond = threading.Condition()
+        self._burst = burst
+        self._global = TokenBucket(rate, burst)
+        self._hosts = {}
+        self._explicit_hosts = set()
+        self._default_host_rate = None
+        # shared by hosts without any limit, so hosts seen in a long crawl are not remembered
+        self._unlimited = TokenBucket()
+        self._limited = False
+        self._waiting = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._swept = time.monotonic()
+        for host, host_rate in (host_rates or {}).items():
+            self._hosts[host] = TokenBucket(host_rate, burst)
+            self._explicit_hosts.add(host)
+        self._update_limited()
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._global.rate
+
+    def set_rate(self, rate: Optional[float]):
+        with self._cond:
+            self._global.rate = rate
+            self._update_limited()
+            self._cond.notify_all()
+
+    def host_rate(self, host: str) -> Optional[float]:
+        with self._cond:
+            return self._host(host).rate
+
+    def set_host_rate(self, host: str, rate: Optional[float]):
+        with self._cond:
+            bucket = self._hosts.get(host)
+            if bucket is None:
+                bucket = self._hosts[host] = TokenBucket(rate, self._burst)
+            else:
+                bucket.rate = rate
+            self._explicit_hosts.add(host)
+            self._update_limited()
+            self._cond.notify_all()
+
+    def set_default_host_rate(self, rate: Optional[float]):
+        """Limits every host without a rate of its own."""
+        with self._cond:
+            for host in list(self._hosts):
+                if host not in self._explicit_hosts:
+                    if rate is None:
+                        del self._hosts[host]
+                    else:
+                        self._hosts[host].rate = rate
+            self._default_host_rate = rate
+            self._update_limited()
+            self._cond.notify_all()
+
+    def _host(self, host: Optional[str]) -> TokenBucket:
+        bucket = self._hosts.get(host)
+        if bucket is None:
+            if self._default_host_rate is None:
+                return self._unlimited
+            bucket = self._hosts[host] = TokenBucket(self._default_host_rate, self._burst)
+        return bucket
+
+    def _evict_idle(self):
+        """Forgets buckets created for the default host rate once they refilled and nobody waits on them."""
+        now = time.monotonic()
+        if now - self._swept < self._SWEEP or len(self._hosts) == len(self._explicit_hosts):
+            return
+        self._swept = now
+        waiting = {w[2] for w in self._waiting}
+        for host in [h for h, b in self._hosts.items()
+                     if h not in self._explicit_hosts and h not in waiting and b.full]:
+            del self._hosts[host]
+
+    def _update_limited(self):
+        self._limited = self._global.rate is not None or self._default_host_rate is not None \
+                        or any(self._hosts[h].rate is not None for h in self._explicit_hosts)
+
+    @property
+    def limited(self) -> bool:
+        """Whether any limit is set, cheap enough to check once per chunk."""
+        return self._limited
+
+    def _ready(self, host: Optional[str], n: int) -> bool:
+        return self._global.ready(n) and self._host(host).ready(n)
+
+    def _delay(self, host: Optional[str], n: int) -> float:
+        return max(self._global.delay(n), self._host(host).delay(n))
+
+    def acquire(self, n: int, host: str = None, weight: float = PRIORITY_BULK):
+        """Blocks until `n` bytes of `host` may be transferred."""
+        if n <= 0:
+            return
+        with self._cond:
+            if not self.limited:
+                return
+            entry = (self._vtime + n / weight, next(self._seq), host, n)
+            self._waiting.append(entry)
+            while True:
+                first = next((w for w in sorted(self._waiting) if self._ready(w[2], w[3])), None)
+                if first is entry:
+                    break
+                if first is None:
+                    # nobody can go yet, sleep until our own buckets refill
+                    timeout = min(self._delay(host, n), self._POLL) or self._POLL
+                else:
+                    timeout = self._POLL
+                self._cond.wait(timeout)
+            self._waiting.remove(entry)
+            self._global.consume(n)
+            self._host(host).consume(n)
+            self._vtime = max(self._vtime, entry[0])
+            self._evict_idle()
+            self._cond.notify_all()
+
+
+_scheduler = BandwidthScheduler()
+
+
+def bandwidth_scheduler() -> BandwidthScheduler:
+    """The process-wide scheduler consulted by all downloads and content fetches."""
+    return _scheduler
@@ -0,0 +1,129 @@
+import unicodedata
+from typing import TextIO
+
+MODE_SCROLL = 1
+MODE_BOTTOM = 4
+MODE_TOP = 5
+
+HEADER = '''[Script Info]
+ScriptType: v4.00+
+Collisions: Normal
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 2
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Barrage,{font},{font_size},&H{alpha:02X}FFFFFF,&H{alpha:02X}FFFFFF,&H{alpha:02X}000000,&H{alpha:02X}000000,0,0,0,0,100,100,0,0,1,1,0,7,0,0,0,0
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+'''
+
+
+def ass_time(seconds: float) -> str:
+    centiseconds = max(0, int(round(seconds * 100)))
+    h, centiseconds = divmod(centiseconds, 360000)
+    m, centiseconds = divmod(centiseconds, 6000)
+    s, centiseconds = divmod(centiseconds, 100)
+    return '{}:{:02}:{:02}.{:02}'.format(h, m, s, centiseconds)
+
+
+def ass_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}').replace('\n', '\\N')
+
+
+def text_width(text: str, font_size: float) -> float:
+    return sum(1 if unicodedata.east_asian_width(c) in 'WF' else 0.5 for c in text) * font_size
+
+
+class AssWriter:
+    """Writes barrages to an ASS file as they arrive.
+
+    Lanes are assigned online from the last barrage of each lane only, so memory does not
+    grow with the number of barrages; events are buffered until `flush`.
+    """
+
+    def __init__(self, f: TextIO, width: int = 1920, height: int = 1080, font: str = 'Microsoft YaHei',
+                 font_size: int = 48, duration: float = 8.0, fixed_duration: float = 4.0,
+                 opacity: float = 0.8, scroll_area: float = 1.0):
+        self._f = f
+        self._width = width
+        self._height = height
+        self._font_size = font_size
+        self._duration = duration
+        self._fixed_duration = fixed_duration
+        num_lanes = max(1, height // font_size)
+        # per lane (start, width) of the last scrolling barrage and end of the last fixed one
+        self._scroll = [None] * max(1, int(num_lanes * scroll_area))
+        self._top = [0.0] * num_lanes
+        self._bottom = [0.0] * num_lanes
+        self._events = []
+        self._f.write(HEADER.format(width=width, height=height, font=font, font_size=font_size,
+                                    alpha=round((1 - opacity) * 255)))
+
+    def _scroll_lane(self, start: float, width: float) -> int:
+        speed = (self._width + width) / self._duration
+        oldest = 0
+        for i, last in enumerate(self._scroll):
+            if last is None:
+                return i
+            last_start, last_width = last
+            last_speed = (self._width + last_width) / self._duration
+            entered = start >= last_start + last_width / last_speed
+            overtaken = start + self._width / speed < last_start + self._duration
+            if entered and not overtaken:
+                return i
+            if last_start < self._scroll[oldest][0]:
+                oldest = i
+        return oldest
+
+    def _fixed_lane(self, lanes: list, start: float) -> int:
+        oldest = 0
+        for i, end in enumerate(lanes):
+            if start >= end:
+                return i
+            if end < lanes[oldest]:
+                oldest = i
+        return oldest
+
+    def add(self, start: float, text: str, mode: int = MODE_SCROLL, color: int = 0xffffff, size: int = 25):
+        """Adds a barrage shown at `start` seconds, `size` and `color` as in Bilibili comments."""
+        font_size = self._font_size * size / 25
+        width = text_width(text, font_size)
+        tags = ''
+        if size != 25:
+            tags += '\\fs{}'.format(round(font_size))
+        if color != 0xffffff:
+            tags += '\\c&H{:02X}{:02X}{:02X}&'.format(color & 0xff, (color >> 8) & 0xff, (color >> 16) & 0xff)
+        if mode == MODE_TOP or mode == MODE_BOTTOM:
+            lanes = self._top if mode == MODE_TOP else self._bottom
+            lane = self._fixed_lane(lanes, start)
+            lanes[lane] = start + self._fixed_duration
+            end = start + self._fixed_duration
+            if mode == MODE_TOP:
+                position = '\\an8\\pos({},{})'.format(self._width // 2, lane * self._font_size)
+            else:
+                position = '\\an2\\pos({},{})'.format(self._width // 2, self._height - lane * self._font_size)
+        else:
+            lane = self._scroll_lane(start, width)
+            self._scroll[lane] = (start, width)
+            end = start + self._duration
+            y = lane * self._font_size
+            position = '\\move({},{},{},{})'.format(self._width, y, -round(width), y)
+        self._events.append('Dialogue: 2,{},{},Barrage,,0,0,0,,{{{}{}}}{}\n'.format(
+            ass_time(start), ass_time(end), position, tags, ass_escape(text)))
+
+    @property
+    def pending(self) -> int:
+        return len(self._events)
+
+    def flush(self):
+        if self._events:
+            self._f.writelines(self._events)
+            self._events.clear()
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+        self._f.close()
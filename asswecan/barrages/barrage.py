@@ -1,13 +1,18 @@
+import logging
 import os
 import threading
 from abc import abstractmethod, ABCMeta
 from typing import Union, Iterator
 from urllib.parse import urlparse
 
-from asswecan.utils import MultiTaskManager, ProgressBar, ensure_valid_path
+from asswecan.barrages.index import BarrageIndex
+from asswecan.net import Deadline, DeadlineExceeded, deadline_scope
+from asswecan.utils import BloomFilter, MultiTaskManager, ProgressBar, ensure_valid_path
 
 
 class Barrage(metaclass=ABCMeta):
+    __slots__ = ('bid', 'url', 'title', 'out_dir', '_content', 'file', '_ass', 'ass_file', '__weakref__')
+
     def __init__(self, bid: str = None, url: str = None, title: str = None, out_dir: str = os.curdir,
                  content: str = None, file: str = None, ass: str = None, ass_file: str = None):
         self.bid = bid
@@ -37,6 +42,18 @@ class Barrage(metaclass=ABCMeta):
             self._ass = self.to_ass()
         return self._ass
 
+    @property
+    def key(self) -> str:
+        """Compact identity of the barrage, equal keys mean equal barrages."""
+        if self.bid:
+            return '{}:bid:{}'.format(self.__class__.__name__, self.bid)
+        return '{}:file:{}'.format(self.__class__.__name__, self.file)
+
+    def release(self):
+        """Drops cached payloads, they are loaded again from file or url on next access."""
+        self._content = None
+        self._ass = None
+
     @classmethod
     @abstractmethod
     def from_info(cls, *args, **kwargs):
@@ -96,10 +113,18 @@ class Barrage(metaclass=ABCMeta):
 
 class BarrageTaskManager(MultiTaskManager, metaclass=ABCMeta):
     def __init__(self, out_dir: str = os.curdir, save: bool = True, convert: bool = True,
-                 all_pages: bool = False, num_threads: int = 4, show_bar: bool = True):
+                 all_pages: bool = False, num_threads: int = 4, show_bar: bool = True,
+                 task_timeout: float = None, low_memory: bool = False, bloom_capacity: int = None,
+                 index: BarrageIndex = None):
         super().__init__(num_threads)
         self.__LOCK = threading.Lock()
-        self.__set = set()
+        # only compact keys are remembered, a Bloom filter trades rare false duplicates for
+        # constant memory on huge crawls
+        self.__set = set() if bloom_capacity is None else BloomFilter(bloom_capacity)
+        self._low_memory = low_memory
+        self._index = index
+        self.__deadlines = set()
+        self._task_timeout = task_timeout
         self._out_dir = out_dir
         self._save = save
         self._convert = convert
@@ -108,37 +133,64 @@ class BarrageTaskManager(MultiTaskManager, metaclass=ABCMeta):
         if self._show_bar:
             self._bar = ProgressBar(0, extra='barrage(s)')
 
+    @staticmethod
+    def _key(item: Union[str, Barrage]) -> str:
+        return item.key if isinstance(item, Barrage) else item
+
     def add_tasks(self, *items: Union[str, Barrage]):
         for item in items:
+            key = self._key(item)
             self.__LOCK.acquire()
-            if item not in self.__set:
+            if key not in self.__set:
                 self._queue.put(item)
-                self.__set.add(item)
+                self.__set.add(key)
             self.__LOCK.release()
 
     def _start_task(self, item: Union[str, Barrage]):
+        deadline = Deadline(self._task_timeout)
+        with self.__LOCK:
+            self.__deadlines.add(deadline)
+            # cancel() may have run after this task was dequeued but before it was registered
+            if self._cancelled.is_set():
+                deadline.cancel()
+        try:
+            with deadline_scope(deadline):
+                self.__start_task(item)
+        except DeadlineExceeded:
+            if not self._cancelled.is_set():
+                raise
+            logging.debug('task cancelled: {}'.format(item))
+        finally:
+            with self.__LOCK:
+                self.__deadlines.discard(deadline)
+
+    def __start_task(self, item: Union[str, Barrage]):
         if isinstance(item, str):
             p = urlparse(item)
             if (p.scheme == 'http' or p.scheme == 'https') and p.netloc:
                 for result in self.process_url(item):
+                    key = result.key
                     self.__LOCK.acquire()
-                    if result not in self.__set:
+                    if key not in self.__set:
                         self._queue.put(result)
-                        self.__set.add(result)
+                        self.__set.add(key)
                         if self._show_bar:
                             self._bar.total += 1
                     self.__LOCK.release()
             else:
                 result = self.process_file(item)
+                key = result.key
                 self.__LOCK.acquire()
-                if result not in self.__set:
+                if key not in self.__set:
                     self._queue.put(result)
-                    self.__set.add(result)
+                    self.__set.add(key)
                     if self._show_bar:
                         self._bar.total += 1
                 self.__LOCK.release()
         elif isinstance(item, Barrage):
             self.process_barrage(item)
+            if self._low_memory:
+                item.release()
             if self._show_bar:
                 self._bar.progress += 1
         else:
@@ -149,6 +201,13 @@ class BarrageTaskManager(MultiTaskManager, metaclass=ABCMeta):
         if self._show_bar:
             self._bar.done()
 
+    def cancel(self):
+        """Discards pending tasks and aborts the requests of the ones in progress."""
+        super().cancel()
+        with self.__LOCK:
+            for deadline in self.__deadlines:
+                deadline.cancel()
+
     @abstractmethod
     def process_url(self, url: str) -> Iterator[Barrage]:
         pass
@@ -159,6 +218,8 @@ class BarrageTaskManager(MultiTaskManager, metaclass=ABCMeta):
 
     def process_barrage(self, brg: Barrage):
         if self._save:
-            brg.save()
+            file = brg.save()
+            if self._index is not None:
+                self._index.add_file(file, brg.content)
         if self._convert:
             brg.save_ass()
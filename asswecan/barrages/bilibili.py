@@ -25,6 +25,8 @@ SUBTITLE = '{}_#{}_{}'
 
 
 class BiliBarrage(Barrage):
+    __slots__ = ()
+
     @classmethod
     def from_info(cls, bid: str, title: str, out_dir: str = os.curdir, **kwargs):
         return cls(bid, API_COMMENT.format(bid), title, out_dir, **kwargs)
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import zlib
+from typing import Iterator, Tuple, Iterable, Optional
+from urllib.request import Request
+
+from asswecan.barrages.ass import AssWriter
+from asswecan.net import url_get_content, fake_headers
+from asswecan.utils import ensure_valid_path
+from asswecan.websocket import WebSocketClosed, connect
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# raised by iter_packets on a corrupt frame
+DECODE_ERRORS = (ValueError, struct.error, zlib.error) + ((brotli.error,) if brotli else ())
+
+WS_DANMAKU = 'wss://broadcastlv.chat.bilibili.com/sub'
+
+API_ROOM_INIT = 'https://api.live.bilibili.com/room/v1/Room/room_init?id={}'
+
+HEADER = struct.Struct('>IHHII')
+
+VER_RAW = 0
+VER_INT = 1
+VER_ZLIB = 2
+VER_BROTLI = 3
+
+OP_HEARTBEAT = 2
+OP_HEARTBEAT_REPLY = 3
+OP_MESSAGE = 5
+OP_AUTH = 7
+OP_AUTH_REPLY = 8
+
+
+def encode_packet(op: int, body: bytes = b'', ver: int = VER_INT) -> bytes:
+    return HEADER.pack(HEADER.size + len(body), HEADER.size, ver, op, 1) + body
+
+
+def iter_packets(data: bytes) -> Iterator[Tuple[int, memoryview]]:
+    """Yields `(op, body)` of every packet in `data`, compressed batches are unpacked in place."""
+    view = memoryview(data)
+    offset = 0
+    while offset + HEADER.size <= len(view):
+        length, header_length, ver, op, _ = HEADER.unpack_from(view, offset)
+        # a zero length would never advance the offset
+        if header_length < HEADER.size or length < header_length or offset + length > len(view):
+            raise ValueError('malformed packet at {}'.format(offset))
+        body = view[offset + header_length:offset + length]
+        offset += length
+        if op == OP_MESSAGE and ver == VER_ZLIB:
+            yield from iter_packets(zlib.decompress(body))
+        elif op == OP_MESSAGE and ver == VER_BROTLI:
+            if brotli is None:
+                logging.warning('brotli is not installed, skipping compressed packet')
+                continue
+            yield from iter_packets(brotli.decompress(bytes(body)))
+        else:
+            yield op, body
+
+
+def real_room_id(room_id: int) -> int:
+    """Resolves a short room id from the live url to the one the danmaku server expects."""
+    info = json.loads(url_get_content(Request(API_ROOM_INIT.format(room_id), headers=fake_headers())))
+    return int(info['data']['room_id'])
+
+
+class BiliLiveRecorder:
+    """Records the danmaku of a live room to an ASS file while the stream runs.
+
+    Times are relative to the moment recording starts, events are flushed every
+    `flush_interval` seconds.
+    """
+
+    def __init__(self, room_id: int, out_dir: str = os.curdir, title: str = None, url: str = WS_DANMAKU,
+                 flush_interval: float = 5.0, heartbeat_interval: float = 30.0,
+                 reconnect_delay: Optional[float] = 5.0, resolve: bool = True, **kwargs):
+        """`room_id` may be the short id of a live url, unless `resolve` is False it is resolved
+        to the real one before connecting."""
+        self.room_id = room_id
+        self.out_dir = out_dir
+        self.title = title if title else 'live_{}'.format(room_id)
+        self.url = url
+        self.ass_file = None
+        self.count = 0
+        self._flush_interval = flush_interval
+        self._heartbeat_interval = heartbeat_interval
+        self._reconnect_delay = reconnect_delay
+        self._resolve = resolve
+        self._ass_kwargs = kwargs
+        self._writer = None
+        self._start = None
+        self._stopped = asyncio.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def on_message(self, message: dict, t: float):
+        cmd = message.get('cmd', '')
+        # newer servers append options to the command, e.g. DANMU_MSG:4:0:2:2:2:0
+        if cmd.split(':', 1)[0] != 'DANMU_MSG':
+            return
+        info = message['info']
+        self._writer.add(t, info[1], mode=info[0][1], size=info[0][2], color=info[0][3])
+        self.count += 1
+
+    def _dispatch(self, data: bytes):
+        # packets batched in one frame arrived together and share a timestamp
+        t = asyncio.get_running_loop().time() - self._start
+        packets = iter_packets(data)
+        while True:
+            try:
+                op, body = next(packets)
+            except StopIteration:
+                break
+            except DECODE_ERRORS as e:
+                logging.warning('room {}, cannot decode frame, skipping: {}'.format(self.room_id, e))
+                break
+            if op != OP_MESSAGE:
+                continue
+            try:
+                self.on_message(json.loads(body.tobytes()), t)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                logging.debug('cannot parse danmaku: {}'.format(e))
+
+    async def _heartbeat(self, ws):
+        try:
+            while True:
+                await ws.send(encode_packet(OP_HEARTBEAT))
+                await asyncio.sleep(self._heartbeat_interval)
+        except ConnectionError:
+            pass
+
+    async def _flush(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            self._writer.flush()
+
+    async def _session(self):
+        ws = await connect(self.url)
+        auth = {'uid': 0, 'roomid': self.room_id, 'protover': 2, 'platform': 'web', 'type': 2}
+        await ws.send(encode_packet(OP_AUTH, json.dumps(auth).encode()))
+        heartbeat = asyncio.ensure_future(self._heartbeat(ws))
+        try:
+            while True:
+                data = await ws.recv()
+                if self._start is None:
+                    self._start = asyncio.get_running_loop().time()
+                self._dispatch(data)
+        finally:
+            heartbeat.cancel()
+            await ws.close()
+
+    async def run(self):
+        """Records until `stop` is called, or until the connection ends if `reconnect_delay` is None."""
+        if self._resolve:
+            self.room_id = await asyncio.get_running_loop().run_in_executor(None, real_room_id, self.room_id)
+            self._resolve = False
+        self.ass_file = ensure_valid_path(self.out_dir, self.title + '.ass')
+        self._writer = AssWriter(open(self.ass_file, 'w'), **self._ass_kwargs)
+        flush = asyncio.ensure_future(self._flush())
+        stopped = asyncio.ensure_future(self._stopped.wait())
+        session = None
+        try:
+            while not self._stopped.is_set():
+                session = asyncio.ensure_future(self._session())
+                await asyncio.wait([session, stopped], return_when=asyncio.FIRST_COMPLETED)
+                if not session.done():
+                    break
+                try:
+                    session.result()
+                except (WebSocketClosed, OSError) as e:
+                    logging.info('room {} disconnected: {}'.format(self.room_id, e))
+                if self._reconnect_delay is None:
+                    break
+                await asyncio.wait([stopped], timeout=self._reconnect_delay)
+        finally:
+            for task in (session, flush, stopped):
+                if task is not None and not task.done():
+                    task.cancel()
+            await asyncio.gather(*(t for t in (session, flush, stopped) if t is not None), return_exceptions=True)
+            self._writer.close()
+        logging.debug('recording completed, room={}, file={}, count={}'.format(
+            self.room_id, self.ass_file, self.count))
+        return self.ass_file
+
+
+async def record_rooms(room_ids: Iterable[int], out_dir: str = os.curdir, **kwargs):
+    """Records several rooms concurrently in the running event loop."""
+    recorders = [BiliLiveRecorder(room_id, out_dir, **kwargs) for room_id in room_ids]
+    return await asyncio.gather(*(r.run() for r in recorders))
@@ -0,0 +1,251 @@
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from typing import Iterator, List, Tuple
+
+# marks the end of a comment so that its last character still starts a bigram
+END = '\x03'
+
+# grams with fewer postings are cheap enough to collect and sort
+RARE_POSTINGS = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    bid TEXT,
+    title TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    file INTEGER NOT NULL,
+    time REAL NOT NULL,
+    user TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_bid ON files (bid);
+CREATE INDEX IF NOT EXISTS comments_file_time ON comments (file, time);
+CREATE INDEX IF NOT EXISTS comments_user ON comments (user);
+CREATE INDEX IF NOT EXISTS comments_time ON comments (time);
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT NOT NULL,
+    comment INTEGER NOT NULL,
+    PRIMARY KEY (gram, comment)
+) WITHOUT ROWID;
+'''
+
+Hit = namedtuple('Hit', ['file', 'bid', 'title', 'time', 'user', 'text'])
+
+
+def normalize(text: str) -> str:
+    return text.lower()
+
+
+def grams(text: str) -> set:
+    """Character bigrams of a normalized comment, CJK text has no word boundaries to split on."""
+    text += END
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def parse_barrages(content: str) -> Tuple[str, Iterator[Tuple[float, str, str]]]:
+    """Returns the chat id and `(time, user, text)` of every comment in a saved Bilibili XML."""
+    m = re.search(r'<chatid>(\d+)</chatid>', content)
+    bid = m.group(1) if m else None
+
+    def comments():
+        for m in re.finditer(r'<d p="([^"]*)">([^<]*)</d>', content):
+            p = m.group(1).split(',')
+            user = p[6] if len(p) > 6 else None
+            yield float(p[0]), user, html.unescape(m.group(2))
+
+    return bid, comments()
+
+
+class BarrageIndex:
+    """An on-disk inverted index over saved barrage files.
+
+    Every comment is posted under its character bigrams, phrases are answered by walking the
+    postings of their rarest bigram and probing the others. Files are indexed again only when
+    their size or modification time changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.create_function('normalize', 1, normalize, deterministic=True)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def num_files(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    @property
+    def num_comments(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM comments').fetchone()[0]
+
+    def _remove(self, file_id: int):
+        old = self._conn.execute('SELECT id, text FROM comments WHERE file = ?', (file_id,))
+        self._conn.executemany('DELETE FROM grams WHERE gram = ? AND comment = ?',
+                               ((g, cid) for cid, text in old.fetchall() for g in grams(normalize(text))))
+        self._conn.execute('DELETE FROM comments WHERE file = ?', (file_id,))
+        self._conn.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def add_file(self, file: str, content: str = None) -> bool:
+        """Indexes `file`, `content` saves reading it again when the caller has it; returns False if up to date."""
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        with self._lock:
+            row = self._conn.execute('SELECT id, mtime, size FROM files WHERE path = ?', (file,)).fetchone()
+            if row and row[1] == stat.st_mtime and row[2] == stat.st_size:
+                return False
+        if content is None:
+            with open(file) as f:
+                content = f.read()
+        bid, comments = parse_barrages(content)
+        title = os.path.basename(file).rsplit('.', 1)[0]
+        with self._lock, self._conn:
+            # another worker may have indexed the same path since the check above
+            row = self._conn.execute('SELECT id, mtime, size FROM files WHERE path = ?', (file,)).fetchone()
+            if row and row[1] == stat.st_mtime and row[2] == stat.st_size:
+                return False
+            if row:
+                self._remove(row[0])
+            file_id = self._conn.execute(
+                'INSERT INTO files (path, bid, title, mtime, size) VALUES (?, ?, ?, ?, ?)',
+                (file, bid, title, stat.st_mtime, stat.st_size)
+            ).lastrowid
+            # ids are assigned here so that comments and their postings go in two batches
+            next_id = self._conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM comments').fetchone()[0]
+            rows = [(next_id + i, file_id, t, user, text) for i, (t, user, text) in enumerate(comments)]
+            self._conn.executemany('INSERT INTO comments (id, file, time, user, text) VALUES (?, ?, ?, ?, ?)', rows)
+            # sorted postings are appended to neighbouring b-tree pages instead of random ones
+            self._conn.executemany('INSERT OR IGNORE INTO grams (gram, comment) VALUES (?, ?)',
+                                   sorted((g, row[0]) for row in rows for g in grams(normalize(row[4]))))
+        logging.debug('indexed file={}, bid={}'.format(file, bid))
+        return True
+
+    def remove_file(self, file: str):
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT id FROM files WHERE path = ?', (os.path.abspath(file),)).fetchone()
+            if row:
+                self._remove(row[0])
+
+    def update(self, directory: str) -> int:
+        """Indexes new or changed `.xml` files under `directory`, returns how many were indexed."""
+        count = 0
+        for root, dirs, files in os.walk(directory):
+            # sorted, so that hits come out in path order after a full update
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.xml'):
+                    try:
+                        count += self.add_file(os.path.join(root, name))
+                    except (OSError, ValueError) as e:
+                        logging.warning('cannot index {}: {}'.format(name, e))
+        return count
+
+    def _count(self, sql: str, args: list) -> int:
+        """Rows of `sql`, counted up to `RARE_POSTINGS` only."""
+        return self._conn.execute('SELECT COUNT(*) FROM ({} LIMIT ?)'.format(sql),
+                                  args + [RARE_POSTINGS + 1]).fetchone()[0]
+
+    def search(self, phrase: str = None, user: str = None, start: float = None, end: float = None,
+               path_prefix: str = None, bid: str = None, limit: int = 100) -> List[Hit]:
+        """Finds comments containing `phrase`, case-insensitively, by `user` hash and within
+        `[start, end]` seconds of the video; `path_prefix` restricts to a directory, such as
+        the one an uploader's barrages were saved to. Hits come in the order files were indexed."""
+        files, files_args = [], []
+        if bid is not None:
+            files.append('bid = ?')
+            files_args.append(bid)
+        if path_prefix is not None:
+            path_prefix = os.path.join(os.path.abspath(path_prefix), '')
+            files.append('path >= ? AND path < ?')
+            files_args += [path_prefix, path_prefix + chr(0x10ffff)]
+        files = 'SELECT id FROM files WHERE ' + ' AND '.join(files) if files else None
+
+        where, args = [], []
+        source, order = 'comments c', 'c.id'
+        with self._lock:
+            # comments of the selected files drive the query through comments_file_time, unless
+            # a phrase has fewer postings to walk
+            file_comments = None
+            if files:
+                file_comments = self._count('SELECT 1 FROM comments WHERE file IN ({})'.format(files), files_args)
+                order = 'c.file, c.time'
+            if phrase:
+                phrase = normalize(phrase)
+                if len(phrase) == 1:
+                    high = phrase + chr(0x10ffff)
+                    postings = self._count('SELECT 1 FROM grams WHERE gram BETWEEN ? AND ?', [phrase, high])
+                    if postings <= RARE_POSTINGS and (file_comments is None or postings < file_comments):
+                        source = '(SELECT DISTINCT comment FROM grams WHERE gram BETWEEN ? AND ?) g ' \
+                                 'CROSS JOIN comments c ON c.id = g.comment'
+                        args += [phrase, high]
+                        order = 'g.comment'
+                    else:
+                        # a common character matches early in any order, scanning beats merging postings
+                        where.append('instr(normalize(c.text), ?) > 0')
+                        args.append(phrase)
+                else:
+                    postings = {}
+                    for i in range(len(phrase) - 1):
+                        term = phrase[i:i + 2]
+                        if term not in postings:
+                            postings[term] = self._count('SELECT 1 FROM grams WHERE gram = ?', [term])
+                    terms = sorted(postings, key=postings.get)
+                    if file_comments is not None and file_comments <= postings[terms[0]]:
+                        probes, key = terms, 'c.id'
+                    else:
+                        # walk the postings of the rarest bigram in comment order and probe the others
+                        source = 'grams g CROSS JOIN comments c ON c.id = g.comment'
+                        order = 'g.comment'
+                        where.append('g.gram = ?')
+                        args.append(terms[0])
+                        probes, key = terms[1:], 'g.comment'
+                    for term in probes:
+                        where.append('EXISTS (SELECT 1 FROM grams WHERE gram = ? AND comment = {})'.format(key))
+                        args.append(term)
+                    where.append('instr(normalize(c.text), ?) > 0')
+                    args.append(phrase)
+            if files:
+                where.append('c.file IN ({})'.format(files))
+                args += files_args
+            if user is not None:
+                where.append('c.user = ?')
+                args.append(user)
+            if start is not None:
+                where.append('c.time >= ?')
+                args.append(start)
+            if end is not None:
+                where.append('c.time <= ?')
+                args.append(end)
+            sql = 'SELECT f.path, f.bid, f.title, c.time, c.user, c.text FROM {} CROSS JOIN files f ' \
+                  'ON f.id = c.file'.format(source)
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            # ordering by the scanned key lets LIMIT stop as soon as enough hits are found
+            sql += ' ORDER BY {} LIMIT ?'.format(order)
+            args.append(limit)
+            return [Hit(*row) for row in self._conn.execute(sql, args)]
@@ -3,15 +3,20 @@ import mimetypes
 import os
 import re
 import socket
+import threading
 import time
 import urllib.parse
 import zlib
-from http.client import HTTPResponse
-from typing import Dict, Union, Tuple, Optional
+from collections import deque
+from contextlib import contextmanager
+from http.client import HTTPMessage, HTTPResponse
+from queue import Queue, Empty
+from typing import Dict, Union, Tuple, Optional, Iterable, List
 from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 
-from asswecan.utils import ProgressBar, readable_size, ensure_valid_path
+from asswecan.bandwidth import PRIORITY_BULK, PRIORITY_INTERACTIVE, bandwidth_scheduler
+from asswecan.utils import MultiTaskManager, ProgressBar, readable_size, ensure_valid_path
 
 
 def fake_headers() -> Dict[str, str]:
@@ -24,27 +29,183 @@ def fake_headers() -> Dict[str, str]:
     }
 
 
-def urlopen_with_retry(url: Union[str, Request], retry: int = 3, **kwargs) -> HTTPResponse:
+class DeadlineExceeded(socket.timeout):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout: float = None):
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def remaining(self) -> Optional[float]:
+        if self.cancelled:
+            return 0
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.monotonic())
+
+    def check(self):
+        if self.remaining() == 0:
+            raise DeadlineExceeded('cancelled' if self.cancelled else 'deadline exceeded')
+
+
+_local = threading.local()
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline):
+    """Applies `deadline` to every request made by the current thread inside the block."""
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def current_deadline() -> Optional[Deadline]:
+    return getattr(_local, 'deadline', None)
+
+
+def urlopen_with_retry(url: Union[str, Request], retry: int = 3, deadline: Deadline = None,
+                       **kwargs) -> HTTPResponse:
     logging.debug('urlopen, request {}'.format(url))
+    if deadline is None:
+        deadline = current_deadline()
+    timeout = kwargs.pop('timeout', socket.getdefaulttimeout())
     for i in range(retry):
+        if deadline:
+            deadline.check()
+            remaining = deadline.remaining()
+            if remaining is not None and (timeout is None or remaining < timeout):
+                timeout = remaining
         try:
-            return urlopen(url, **kwargs)
+            if timeout is None:
+                return urlopen(url, **kwargs)
+            return urlopen(url, timeout=timeout, **kwargs)
         except socket.timeout as e:
             logging.info('request attempt {} timeout'.format(i + 1))
             if i + 1 == retry:
                 raise e
         except HTTPError as e:
             logging.info('HTTPError with code {}'.format(e.code))
-            if i + 1 == retry:
+            # the same request would get the same client error, except for a timeout or throttling
+            if i + 1 == retry or 400 <= e.code < 500 and e.code not in (408, 429):
                 raise e
 
 
-def url_get_content(url: Union[str, Request], decode: bool = True, **kwargs) -> Union[bytes, str]:
+class LatencyTracker:
+    def __init__(self, size: int = 100, min_samples: int = 10):
+        self._lock = threading.Lock()
+        self._size = size
+        self._min_samples = min_samples
+        self._samples = {}
+
+    def record(self, host: str, latency: float):
+        with self._lock:
+            self._samples.setdefault(host, deque(maxlen=self._size)).append(latency)
+
+    def percentile(self, host: str, p: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(host, ()))
+        if len(samples) < self._min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+HEDGE_DEFAULT_DELAY = 1.0
+
+THROTTLED_CHUNK_SIZE = 64 * 1024
+
+_latency = LatencyTracker()
+
+
+def _fetch(url: Union[str, Request], priority: float = PRIORITY_INTERACTIVE,
+           **kwargs) -> Tuple[HTTPMessage, bytes]:
+    scheduler = bandwidth_scheduler()
+    with urlopen_with_retry(url, **kwargs) as response:
+        if not scheduler.limited:
+            return response.headers, response.read()
+        host = urllib.parse.urlparse(response.geturl()).netloc
+        data = bytearray()
+        buffer = response.read(THROTTLED_CHUNK_SIZE)
+        while buffer:
+            scheduler.acquire(len(buffer), host, priority)
+            data += buffer
+            buffer = response.read(THROTTLED_CHUNK_SIZE)
+        return response.headers, bytes(data)
+
+
+def _race(url: Union[str, Request], hedge_delay: Optional[float], deadline: Optional[Deadline],
+          **kwargs) -> Tuple[HTTPMessage, bytes]:
+    results = Queue()
+
+    def attempt():
+        try:
+            results.put((True, _fetch(url, deadline=deadline, **kwargs)))
+        except Exception as e:
+            results.put((False, e))
+
+    # attempts run on daemon threads so that an expired or cancelled deadline returns at once
+    # and leaves hung sockets behind instead of waiting on them
+    threading.Thread(target=attempt, daemon=True).start()
+    launched, failed = 1, 0
+    hedge_at = None if hedge_delay is None else time.monotonic() + hedge_delay
+    while True:
+        try:
+            ok, value = results.get(timeout=0.05)
+        except Empty:
+            if deadline:
+                deadline.check()
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                logging.debug('hedge request {}'.format(url))
+                threading.Thread(target=attempt, daemon=True).start()
+                launched, hedge_at = launched + 1, None
+            continue
+        if ok:
+            return value
+        failed += 1
+        if failed == launched:
+            raise value
+
+
+def url_get_content(url: Union[str, Request], decode: bool = True, hedge: float = None,
+                    deadline: Deadline = None, priority: float = PRIORITY_INTERACTIVE,
+                    **kwargs) -> Union[bytes, str]:
+    """Retrieves `url`, decompressed and optionally decoded.
+
+    When `hedge` is set, a GET still unanswered after that percentile of the host's recent
+    latencies is duplicated, and whichever copy responds first wins. `priority` is the weight
+    of the transfer in the process-wide bandwidth scheduler.
+    """
     logging.debug('get content, request {}'.format(url))
-    response = urlopen_with_retry(url, **kwargs)
-    data = response.read()
+    if deadline is None:
+        deadline = current_deadline()
+    request = url if isinstance(url, Request) else Request(url)
+    host = request.host
+    if hedge is not None and request.get_method() != 'GET':
+        hedge = None
+    begin = time.monotonic()
+    if hedge is None and deadline is None:
+        headers, data = _fetch(url, priority, **kwargs)
+    else:
+        hedge_delay = None
+        if hedge is not None:
+            hedge_delay = _latency.percentile(host, hedge)
+            if hedge_delay is None:
+                hedge_delay = HEDGE_DEFAULT_DELAY
+        headers, data = _race(url, hedge_delay, deadline, priority=priority, **kwargs)
+    _latency.record(host, time.monotonic() - begin)
 
-    content_encoding = response.headers['Content-Encoding']
+    content_encoding = headers['Content-Encoding']
     if content_encoding == 'gzip':
         data = zlib.decompress(data, zlib.MAX_WBITS | 16)
     elif content_encoding == 'deflate':
@@ -58,7 +219,7 @@ def url_get_content(url: Union[str, Request], decode: bool = True, **kwargs) ->
 
     if decode:
         charset = None
-        content_type = response.headers['Content-Type']
+        content_type = headers['Content-Type']
         if content_type:
             m = re.search(r'charset=([\w-]+)', content_type)
             if m:
@@ -70,104 +231,245 @@ def url_get_content(url: Union[str, Request], decode: bool = True, **kwargs) ->
     return data
 
 
+def _response_file(response: HTTPResponse) -> Tuple[str, Optional[int], int]:
+    name, size, offset = None, None, 0
+    if response.headers['Content-Disposition']:
+        m = re.search(r'filename="(.+)"', response.headers['Content-Disposition'])
+        if m:
+            name = m.group(1)
+    if not name:
+        name = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(response.geturl()).path))
+        if not name:
+            name = 'file'
+            content_type = response.headers['Content-Type']
+            ext = mimetypes.guess_extension(content_type.rsplit(';', 1)[0]) if content_type else None
+            if ext:
+                name += ext
+    if response.headers['Content-Range']:
+        m = re.search(r'(\d+)-(\d+)/(\d+)$', response.headers['Content-Range'])
+        if m:
+            offset, size = int(m.group(1)), int(m.group(3))
+    elif response.headers['Content-Length']:
+        size = int(response.headers['Content-Length'])
+    return name, size, offset
+
+
 def url_save_guess_file(url: Union[str, Request], **kwargs) -> Tuple[str, Optional[int]]:
     logging.debug('guess file, request {}'.format(url))
-    name, size = None, None
     with urlopen_with_retry(url, **kwargs) as response:
-        if response.headers['Content-Disposition']:
-            m = re.search(r'filename="(.+)"', response.headers['Content-Disposition'])
-            if m:
-                name = m.group(1)
-        if not name:
-            name = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(response.geturl()).path))
-            if not name:
-                name = 'file'
-                ext = mimetypes.guess_extension(response.headers['Content-Type'].rsplit(';', 1)[0])
-                if ext:
-                    name += ext
-        if response.headers['Content-Length']:
-            size = int(response.headers['Content-Length'])
+        name, size, _ = _response_file(response)
     logging.debug('guess file, name={}, size={}'.format(name, size))
     return name, size
 
 
-def url_save(url: str, headers: Dict[str, str] = None,
-             out_dir: str = os.curdir, filename: str = None,
-             force: bool = False, show_bar: bool = False, **kwargs) -> Tuple[str, int]:
-    logging.debug(
-        'url save, url={}, headers={}, out={}, file={}, force={}, show_bar={}'.format(
-            url, headers, out_dir, filename, force, show_bar
-        )
-    )
-    if headers is None:
-        headers = {}
-    name, total_size = url_save_guess_file(Request(url, headers=headers), **kwargs)
-    if total_size is None:
-        total_size = float('inf')
-
-    if filename is None:
-        filename = name
-    file_path = ensure_valid_path(out_dir, filename, force)
-
-    mode = 'wb'
-    part_file = file_path + '.part' if total_size != float('inf') else file_path
-    part_size = 0
+def _numbered(file: str, n: int) -> str:
+    name = file.rsplit('.', 1)
+    if len(name) == 1:
+        return '{} ({})'.format(name[0], n)
+    return '{} ({}).{}'.format(name[0], n, name[1])
+
+
+def _part_size(file_path: str) -> int:
+    part_file = file_path + '.part'
     if os.path.exists(part_file):
-        part_size = os.path.getsize(part_file)
-        if 0 < part_size < total_size:
-            logging.info('\'.part\' file already exists, try to append')
-            mode = 'ab'
-        else:
-            part_size = 0
+        return os.path.getsize(part_file)
+    return 0
+
+
+class DownloadSession:
+    """Downloads files with one request per file.
 
-    bar = None
-    if show_bar:
-        bar = DownloadBar(total_size, part_size)
-        bar.update()
+    File name, size and resume offset are taken from the body response, redirect targets are
+    remembered per url, and paths claimed by running downloads are never handed out twice.
+    """
 
-    if part_size < total_size:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._redirects = {}
+        self._reserved = set()
+
+    def resolve(self, url: str) -> str:
+        with self._lock:
+            return self._redirects.get(url, url)
+
+    def open(self, url: str, headers: Dict[str, str], **kwargs) -> HTTPResponse:
+        target = self.resolve(url)
+        try:
+            response = urlopen_with_retry(Request(target, headers=headers), **kwargs)
+        except HTTPError as e:
+            if target == url or e.code == 416:
+                raise e
+            logging.info('cached redirect {} failed with code {}, resolving again'.format(target, e.code))
+            with self._lock:
+                self._redirects.pop(url, None)
+            response = urlopen_with_retry(Request(url, headers=headers), **kwargs)
+        final = response.geturl()
+        if final != url:
+            with self._lock:
+                self._redirects[url] = final
+        return response
+
+    def _reserve(self, out_dir: str, filename: str, force: bool) -> str:
+        with self._lock:
+            file_path = ensure_valid_path(out_dir, filename, force)
+            n = 1
+            while file_path in self._reserved:
+                file_path = ensure_valid_path(out_dir, _numbered(filename, n), force)
+                n += 1
+            self._reserved.add(file_path)
+        return file_path
+
+    def _release(self, file_path: str):
+        with self._lock:
+            self._reserved.discard(file_path)
+
+    def _open_from(self, url: str, headers: Dict[str, str], part_size: int, **kwargs) -> HTTPResponse:
+        headers = dict(headers)
         if part_size:
             headers['Range'] = 'bytes={}-'.format(part_size)
-        response = urlopen_with_retry(Request(url, headers=headers), **kwargs)
-        remaining_size = float('inf')
-        if response.headers['Content-Range']:
-            m = re.search(r'(\d+)-(\d+)/(\d+)$', response.headers['Content-Range'])
-            remaining_size = int(m.group(3)) - int(m.group(1))
-        elif response.headers['Content-Length']:
-            remaining_size = int(response.headers['Content-Length'])
-        if part_size + remaining_size != total_size:
+        try:
+            return self.open(url, headers, **kwargs)
+        except HTTPError as e:
+            if not part_size or e.code != 416:
+                raise e
+            logging.info('\'.part\' file not satisfiable by server, retrieving')
+            headers.pop('Range')
+            return self.open(url, headers, **kwargs)
+
+    def save(self, url: str, headers: Dict[str, str] = None,
+             out_dir: str = os.curdir, filename: str = None,
+             force: bool = False, show_bar: bool = False, priority: float = PRIORITY_BULK,
+             **kwargs) -> Tuple[str, int]:
+        logging.debug(
+            'url save, url={}, headers={}, out={}, file={}, force={}, show_bar={}'.format(
+                url, headers, out_dir, filename, force, show_bar
+            )
+        )
+        headers = {} if headers is None else dict(headers)
+
+        file_path = None
+        part_size = 0
+        if filename is not None:
+            file_path = self._reserve(out_dir, filename, force)
+            part_size = _part_size(file_path)
+        try:
+            response = self._open_from(url, headers, part_size, **kwargs)
+            name, total_size, offset = _response_file(response)
+            if file_path is None:
+                file_path = self._reserve(out_dir, name, force)
+                if total_size is not None:
+                    part_size = _part_size(file_path)
+                    if 0 < part_size < total_size:
+                        logging.info('\'.part\' file already exists, try to append')
+                        response.close()
+                        response = self._open_from(url, headers, part_size, **kwargs)
+                        _, total_size, offset = _response_file(response)
+            if total_size is None:
+                total_size = float('inf')
+            return self._receive(url, headers, response, file_path, total_size, part_size, offset,
+                                 show_bar, priority, **kwargs)
+        finally:
+            if file_path is not None:
+                self._release(file_path)
+
+    def _receive(self, url: str, headers: Dict[str, str], response: HTTPResponse,
+                 file_path: str, total_size: Union[int, float], part_size: int, offset: int,
+                 show_bar: bool, priority: float, **kwargs) -> Tuple[str, int]:
+        part_file = file_path + '.part' if total_size != float('inf') else file_path
+        if not 0 < part_size < total_size:
+            part_size = 0
+        if part_size != offset:
             logging.info('\'.part\' file inconsistent with server, retrieving')
             part_size = 0
-            mode = 'wb'
-            if show_bar:
-                bar.progress = part_size
-        with open(part_file, mode) as f:
-            while part_size < total_size:
-                buffer = None
-                try:
-                    buffer = response.read(512 * 1024)
-                except socket.timeout:
-                    logging.info('timeout during downloading, retrying')
-                    pass
-                if buffer:
-                    f.write(buffer)
-                    part_size += len(buffer)
-                    if show_bar:
-                        bar.increment(len(buffer))
-                else:
-                    if part_size >= total_size or total_size == float('inf'):
-                        break
-                    headers['Range'] = 'bytes={}-'.format(part_size)
-                    response = urlopen_with_retry(Request(url, headers=headers), **kwargs)
-    if show_bar:
-        bar.done()
-    assert part_size == os.path.getsize(part_file)
-    if part_file != file_path:
-        if os.access(file_path, os.W_OK):
-            os.remove(file_path)
-        os.rename(part_file, file_path)
-    logging.debug('downloading completed, file={}, size={}'.format(file_path, part_size))
-    return file_path, part_size
+            if offset:
+                response.close()
+                response = self._open_from(url, headers, 0, **kwargs)
+        mode = 'ab' if part_size else 'wb'
+
+        scheduler = bandwidth_scheduler()
+        bar = None
+        if show_bar:
+            bar = DownloadBar(total_size, part_size)
+            bar.update()
+
+        try:
+            with open(part_file, mode) as f:
+                while part_size < total_size:
+                    buffer = None
+                    try:
+                        buffer = response.read(THROTTLED_CHUNK_SIZE if scheduler.limited else 512 * 1024)
+                    except socket.timeout:
+                        logging.info('timeout during downloading, retrying')
+                        pass
+                    if buffer:
+                        scheduler.acquire(len(buffer), urllib.parse.urlparse(response.geturl()).netloc, priority)
+                        f.write(buffer)
+                        part_size += len(buffer)
+                        if show_bar:
+                            bar.increment(len(buffer))
+                    else:
+                        if part_size >= total_size or total_size == float('inf'):
+                            break
+                        response.close()
+                        response = self._open_from(url, headers, part_size, **kwargs)
+        finally:
+            response.close()
+        if show_bar:
+            bar.done()
+        assert part_size == os.path.getsize(part_file)
+        if part_file != file_path:
+            if os.access(file_path, os.W_OK):
+                os.remove(file_path)
+            os.rename(part_file, file_path)
+        logging.debug('downloading completed, file={}, size={}'.format(file_path, part_size))
+        return file_path, part_size
+
+
+_session = DownloadSession()
+
+
+def url_save(url: str, headers: Dict[str, str] = None,
+             out_dir: str = os.curdir, filename: str = None,
+             force: bool = False, show_bar: bool = False, priority: float = PRIORITY_BULK,
+             **kwargs) -> Tuple[str, int]:
+    return _session.save(url, headers, out_dir, filename, force, show_bar, priority, **kwargs)
+
+
+class DownloadTaskManager(MultiTaskManager):
+    def __init__(self, session: DownloadSession = None, num_threads: int = 4, **kwargs):
+        super().__init__(num_threads)
+        self._session = _session if session is None else session
+        self._kwargs = kwargs
+        self.results = {}
+
+    def add_tasks(self, *urls: str):
+        for url in urls:
+            self._queue.put(url)
+
+    def _start_task(self, url: str):
+        try:
+            self.results[url] = self._session.save(url, **self._kwargs)
+        except Exception as e:
+            logging.error('error occurs when downloading: {}'.format(url))
+            logging.exception(e)
+            self.results[url] = e
+
+
+def url_save_many(urls: Iterable[str], headers: Dict[str, str] = None,
+                  out_dir: str = os.curdir, force: bool = False,
+                  num_threads: int = 4, **kwargs) -> List[Union[Tuple[str, int], Exception]]:
+    """Downloads `urls` with at most `num_threads` transfers in flight.
+
+    Returns one entry per url in the same order, either `(file_path, size)` as `url_save` does
+    or the exception which stopped that download.
+    """
+    urls = list(urls)
+    manager = DownloadTaskManager(num_threads=num_threads, headers=headers, out_dir=out_dir, force=force,
+                                  **kwargs)
+    manager.start()
+    manager.add_tasks(*dict.fromkeys(urls))
+    manager.join()
+    return [manager.results[url] for url in urls]
 
 
 class DownloadBar(ProgressBar):
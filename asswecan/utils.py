@@ -1,10 +1,12 @@
+import hashlib
 import logging
+import math
 import os
 import re
 import sys
 import threading
 from abc import ABCMeta, abstractmethod
-from queue import Queue
+from queue import Queue, Empty
 from typing import Callable
 
 
@@ -48,6 +50,37 @@ def readable_size(value: int) -> str:
     return '{} GB'.format(value)
 
 
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError('invalid capacity or error rate')
+        self._size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self._num_hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def _indexes(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self._num_hashes):
+            yield (h1 + i * h2) % self._size
+
+    def add(self, item: str):
+        added = False
+        for i in self._indexes(item):
+            if not self._bits[i >> 3] & (1 << (i & 7)):
+                self._bits[i >> 3] |= 1 << (i & 7)
+                added = True
+        if added:
+            self._count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(item))
+
+    def __len__(self):
+        return self._count
+
+
 class ProgressBar:
     def __init__(self, total: int = 100, progress: int = 0, detail: Callable[[int], str] = None, extra: str = None):
         self._total = total
@@ -115,6 +148,7 @@ class MultiTaskManager(metaclass=ABCMeta):
         self._queue = Queue()
         self._num_threads = num_threads
         self._threads = []
+        self._cancelled = threading.Event()
 
     @property
     def num_tasks(self):
@@ -137,6 +171,9 @@ class MultiTaskManager(metaclass=ABCMeta):
             item = self._queue.get()
             if item is None:
                 break
+            if self._cancelled.is_set():
+                self._queue.task_done()
+                continue
             try:
                 self._start_task(item)
             except Exception as e:
@@ -156,3 +193,17 @@ class MultiTaskManager(metaclass=ABCMeta):
             self._queue.put(None)
         for t in self._threads:
             t.join()
+
+    def cancel(self):
+        """Discards pending tasks, the ones in progress still run to completion."""
+        self._cancelled.set()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._queue.task_done()
+            else:
+                self._queue.put(None)
+                break
@@ -0,0 +1,147 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import struct
+import urllib.parse
+from typing import Dict, Tuple
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+
+class WebSocketClosed(ConnectionError):
+    pass
+
+
+def mask_payload(mask: bytes, data: bytes) -> bytes:
+    n = len(data)
+    if not n:
+        return data
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+
+def accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[bool, int, bytes]:
+    head = await reader.readexactly(2)
+    fin, opcode = bool(head[0] & 0x80), head[0] & 0x0f
+    masked, length = bool(head[1] & 0x80), head[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if masked else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = mask_payload(mask, payload)
+    return fin, opcode, payload
+
+
+def encode_frame(opcode: int, payload: bytes, mask: bool) -> bytes:
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('>BB', 0x80 | opcode, (0x80 if mask else 0) | length)
+    elif length < 1 << 16:
+        head = struct.pack('>BBH', 0x80 | opcode, (0x80 if mask else 0) | 126, length)
+    else:
+        head = struct.pack('>BBQ', 0x80 | opcode, (0x80 if mask else 0) | 127, length)
+    if not mask:
+        return head + payload
+    key = os.urandom(4)
+    return head + key + mask_payload(key, payload)
+
+
+class WebSocket:
+    """A minimal websocket client connection, messages are received whole."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def send(self, data: bytes, opcode: int = OP_BINARY):
+        if self._closed:
+            raise WebSocketClosed('send on closed websocket')
+        self._writer.write(encode_frame(opcode, data, True))
+        await self._writer.drain()
+
+    async def recv(self) -> bytes:
+        fragments = []
+        while True:
+            try:
+                fin, opcode, payload = await read_frame(self._reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                self._closed = True
+                raise WebSocketClosed('connection lost') from e
+            if opcode == OP_PING:
+                await self.send(payload, OP_PONG)
+            elif opcode == OP_PONG:
+                pass
+            elif opcode == OP_CLOSE:
+                if not self._closed:
+                    await self.close()
+                raise WebSocketClosed('closed by peer')
+            else:
+                fragments.append(payload)
+                if fin:
+                    return fragments[0] if len(fragments) == 1 else b''.join(fragments)
+
+    async def close(self):
+        if self._closed:
+            return
+        try:
+            self._writer.write(encode_frame(OP_CLOSE, struct.pack('>H', 1000), True))
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+        self._closed = True
+        self._writer.close()
+
+
+async def connect(url: str, headers: Dict[str, str] = None, **kwargs) -> WebSocket:
+    logging.debug('websocket connect {}'.format(url))
+    pr = urllib.parse.urlparse(url)
+    secure = pr.scheme == 'wss'
+    port = pr.port or (443 if secure else 80)
+    reader, writer = await asyncio.open_connection(pr.hostname, port, ssl=secure or None, **kwargs)
+    key = base64.b64encode(os.urandom(16)).decode()
+    lines = [
+        'GET {} HTTP/1.1'.format((pr.path or '/') + ('?' + pr.query if pr.query else '')),
+        'Host: {}'.format(pr.netloc),
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        'Sec-WebSocket-Key: {}'.format(key),
+        'Sec-WebSocket-Version: 13',
+    ]
+    for name, value in (headers or {}).items():
+        lines.append('{}: {}'.format(name, value))
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    await writer.drain()
+
+    status = (await reader.readline()).decode('latin-1').split()
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    if len(status) < 2 or status[1] != '101' or response_headers.get('sec-websocket-accept') != accept_key(key):
+        writer.close()
+        raise ConnectionError('websocket handshake failed: {}'.format(' '.join(status)))
+    return WebSocket(reader, writer)
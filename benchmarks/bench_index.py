@@ -0,0 +1,97 @@
+"""Query latency of BarrageIndex over a synthetic corpus.
+
+Run with `python -m benchmarks.bench_index [num_files]`; 100 files of 3000 comments each
+by default, about the scale at which a full sort of every match costs hundreds of ms. Files
+are saved 10 to a directory like the barrages of one uploader, and queries restricted to the
+last indexed video or directory must not scan the comments of the others.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from asswecan.barrages.index import BarrageIndex
+
+COMMENTS_PER_FILE = 3000
+
+FILES_PER_DIR = 10
+
+# bid and directory queries of the last indexed file, the worst case for a scan in id order
+MAX_SCOPED_MS = 20
+
+# a small alphabet of common danmaku characters makes every bigram frequent, the worst case
+CHARS = '前方高能预警哈哈哈这个好看吗真的假的草笑死我了awsl'
+
+QUERIES = ['哈哈', '前方高能', '笑死我了', '哈', '草', 'awsl', '不存在的']
+
+
+def build(out_dir: str, num_files: int) -> BarrageIndex:
+    rnd = random.Random(0)
+    for v in range(num_files):
+        up_dir = os.path.join(out_dir, 'up{:04}'.format(v // FILES_PER_DIR))
+        os.makedirs(up_dir, exist_ok=True)
+        with open(os.path.join(up_dir, 'v{}.xml'.format(v)), 'w') as f:
+            f.write('<i><chatid>{}</chatid>\n'.format(v))
+            for _ in range(COMMENTS_PER_FILE):
+                text = ''.join(rnd.choice(CHARS) for _ in range(rnd.randint(2, 12)))
+                f.write('<d p="{:.3f},1,25,16777215,0,0,{:08x},0">{}</d>\n'.format(
+                    rnd.random() * 600, rnd.getrandbits(32), text))
+            f.write('</i>')
+    index = BarrageIndex(os.path.join(out_dir, 'index.db'))
+    begin = time.monotonic()
+    index.update(out_dir)
+    print('indexed {} comments in {:.1f} s'.format(index.num_comments, time.monotonic() - begin))
+    return index
+
+
+def measure(fn, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - begin)
+    return best * 1000
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    out_dir = tempfile.mkdtemp()
+    try:
+        with build(out_dir, num_files) as index:
+            print('{:<24} {:>6} {:>10}'.format('query', 'hits', 'ms'))
+            for q in QUERIES:
+                hits = len(index.search(q))
+                print('{:<24} {:>6} {:>10.2f}'.format(q, hits, measure(lambda: index.search(q))))
+            user = index.search('哈哈', limit=1)[0].user
+            for name, kwargs in (('user', {'user': user}),
+                                 ('time range', {'start': 100, 'end': 101}),
+                                 ('phrase in directory', {'phrase': '高能', 'path_prefix': out_dir}),
+                                 ('phrase in time range', {'phrase': '笑死', 'start': 300, 'end': 310})):
+                hits = len(index.search(**kwargs))
+                print('{:<24} {:>6} {:>10.2f}'.format(name, hits, measure(lambda: index.search(**kwargs))))
+
+            last_bid = str(num_files - 1)
+            last_dir = os.path.join(out_dir, 'up{:04}'.format((num_files - 1) // FILES_PER_DIR))
+            for name, kwargs in (('last bid', {'bid': last_bid}),
+                                 ('last bid, time range', {'bid': last_bid, 'start': 100, 'end': 200}),
+                                 ('phrase in last bid', {'phrase': '高能', 'bid': last_bid}),
+                                 ('last directory', {'path_prefix': last_dir}),
+                                 ('missing directory', {'path_prefix': os.path.join(out_dir, 'none')})):
+                hits = index.search(**kwargs)
+                ms = measure(lambda: index.search(**kwargs))
+                print('{:<24} {:>6} {:>10.2f}'.format(name, len(hits), ms))
+                if 'bid' in kwargs:
+                    assert hits and all(h.bid == last_bid for h in hits), name
+                elif name == 'last directory':
+                    assert hits and all(h.file.startswith(last_dir) for h in hits), name
+                else:
+                    assert not hits, name
+                assert ms < MAX_SCOPED_MS, '{} took {:.1f} ms'.format(name, ms)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    main()
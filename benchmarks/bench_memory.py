@@ -0,0 +1,96 @@
+"""Memory retained by BarrageTaskManager over a crawl of synthetic barrages.
+
+Run with `python -m benchmarks.bench_memory`. The 'object set' rows reproduce the old
+dedup set holding every Barrage, whose retained size grows with the payloads. With compact
+keys only the keys remain, a few hundred bytes per barrage, or the fixed size of the Bloom
+filter. The 'caller retains' rows keep every barrage alive outside the manager, where only
+low_memory releasing the payloads keeps the size down.
+"""
+import gc
+import os
+import shutil
+import tempfile
+import tracemalloc
+from typing import Iterator, Tuple
+
+from asswecan.barrages.barrage import Barrage, BarrageTaskManager
+
+PAYLOAD_SIZE = 256 * 1024
+
+
+class FakeBarrage(Barrage):
+    __slots__ = ()
+
+    @classmethod
+    def from_info(cls, bid: str, out_dir: str = os.curdir):
+        return cls(bid, 'http://localhost/{}.xml'.format(bid), bid, out_dir)
+
+    def filename(self) -> str:
+        return self.title + '.xml'
+
+    def retrieve_content(self) -> str:
+        return self.bid[-1] * PAYLOAD_SIZE
+
+    def to_ass(self) -> str:
+        return self.content.upper()
+
+
+class FakeTaskManager(BarrageTaskManager):
+    def __init__(self, count: int, retain: bool = False, object_set: bool = False, **kwargs):
+        super().__init__(show_bar=False, **kwargs)
+        self._count = count
+        self._retain = retain
+        self._object_set = object_set
+        self.barrages = []
+        self.objects = set()
+
+    def process_url(self, url: str) -> Iterator[Barrage]:
+        for i in range(self._count):
+            brg = FakeBarrage.from_info(str(i), self._out_dir)
+            if self._retain:
+                # keep the objects alive like a caller holding its results would
+                self.barrages.append(brg)
+            yield brg
+
+    def process_barrage(self, brg: Barrage):
+        super().process_barrage(brg)
+        if self._object_set:
+            # what the dedup set held before it stored compact keys
+            self.objects.add(brg)
+
+    def process_file(self, file: str) -> Barrage:
+        raise NotImplementedError
+
+
+def run(count: int, **kwargs) -> Tuple[int, int]:
+    out_dir = tempfile.mkdtemp()
+    try:
+        gc.collect()
+        tracemalloc.start()
+        manager = FakeTaskManager(count, out_dir=out_dir, **kwargs)
+        manager.add_tasks('http://localhost/crawl')
+        manager.start()
+        manager.join()
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return retained, peak
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def main():
+    print('{:>8} {:<28} {:>14} {:>14}'.format('count', 'mode', 'retained KB', 'peak KB'))
+    for count in (50, 200):
+        for mode, kwargs in (('object set (old)', {'object_set': True}),
+                             ('default', {}),
+                             ('low_memory', {'low_memory': True}),
+                             ('low_memory+bloom', {'low_memory': True, 'bloom_capacity': 10 ** 6}),
+                             ('caller retains', {'retain': True}),
+                             ('caller retains+low_memory', {'retain': True, 'low_memory': True})):
+            retained, peak = run(count, **kwargs)
+            print('{:>8} {:<28} {:>14} {:>14}'.format(count, mode, retained // 1024, peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import threading
+import time
+from unittest import TestCase
+
+from asswecan.bandwidth import *
+
+
+class TestBandwidth(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        self.assertTrue(bucket.ready(1000))
+        bucket.consume(1000)
+        self.assertFalse(bucket.ready(500))
+        self.assertAlmostEqual(0.5, bucket.delay(500), delta=0.05)
+        bucket.rate = None
+        self.assertTrue(bucket.ready(10 ** 9))
+
+    def test_unlimited(self):
+        scheduler = BandwidthScheduler()
+        begin = time.monotonic()
+        for _ in range(1000):
+            scheduler.acquire(1024 * 1024)
+        self.assertLess(time.monotonic() - begin, 0.5)
+
+    def test_global_rate(self):
+        scheduler = BandwidthScheduler(100 * 1024)
+        begin = time.monotonic()
+        for _ in range(10):
+            scheduler.acquire(20 * 1024)
+        # the first 100 KB burst is free, the other 100 KB takes a second
+        self.assertAlmostEqual(1, time.monotonic() - begin, delta=0.3)
+
+    def test_host_rate(self):
+        scheduler = BandwidthScheduler(host_rates={'slow': 10 * 1024})
+        begin = time.monotonic()
+        for _ in range(100):
+            scheduler.acquire(10 * 1024, 'fast')
+        self.assertLess(time.monotonic() - begin, 0.5)
+        scheduler.acquire(10 * 1024, 'slow')
+        scheduler.acquire(5 * 1024, 'slow')
+        self.assertAlmostEqual(0.5, time.monotonic() - begin, delta=0.2)
+
+    def test_priority(self):
+        scheduler = BandwidthScheduler(200 * 1024)
+        scheduler.acquire(200 * 1024)
+        received = {PRIORITY_BULK: 0, PRIORITY_INTERACTIVE: 0}
+        stop = time.monotonic() + 1.5
+
+        def transfer(weight):
+            while time.monotonic() < stop:
+                scheduler.acquire(4 * 1024, 'host', weight)
+                received[weight] += 4 * 1024
+
+        threads = [threading.Thread(target=transfer, args=(w,)) for w in received]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreater(received[PRIORITY_INTERACTIVE], 3 * received[PRIORITY_BULK])
+
+    def test_set_rate_at_runtime(self):
+        scheduler = BandwidthScheduler(1024)
+        scheduler.acquire(1024)
+        threading.Timer(0.2, scheduler.set_rate, args=(None,)).start()
+        begin = time.monotonic()
+        scheduler.acquire(100 * 1024)
+        self.assertAlmostEqual(0.2, time.monotonic() - begin, delta=0.15)
+
+    def test_limited_with_many_hosts(self):
+        scheduler = BandwidthScheduler()
+        self.assertFalse(scheduler.limited)
+        errors = []
+        stop = threading.Event()
+
+        def poll():
+            try:
+                while not stop.is_set():
+                    scheduler.limited
+            except Exception as e:
+                errors.append(e)
+
+        t = threading.Thread(target=poll)
+        t.start()
+        scheduler.set_host_rate('limited', 10 ** 9)
+        for i in range(20000):
+            scheduler.acquire(1, 'host{}'.format(i))
+        stop.set()
+        t.join()
+        self.assertEqual([], errors)
+        self.assertTrue(scheduler.limited)
+        # hosts without a limit of their own share one bucket instead of one each
+        self.assertEqual(1, len(scheduler._hosts))
+        scheduler.set_host_rate('limited', None)
+        self.assertFalse(scheduler.limited)
+        scheduler.set_default_host_rate(1024)
+        self.assertTrue(scheduler.limited)
+        self.assertEqual(1024, scheduler.host_rate('other'))
+        scheduler.set_default_host_rate(None)
+        self.assertFalse(scheduler.limited)
+
+    def test_evict_idle_hosts(self):
+        scheduler = BandwidthScheduler(burst=0.01)
+        scheduler._SWEEP = 0
+        scheduler.set_host_rate('limited', 10 ** 6)
+        scheduler.set_default_host_rate(10 ** 6)
+        for i in range(1000):
+            scheduler.acquire(1, 'host{}'.format(i))
+        # every bucket refills within 10 ms, only the one just consumed from may be kept
+        time.sleep(0.05)
+        scheduler.acquire(1, 'last')
+        self.assertIn('limited', scheduler._hosts)
+        self.assertLessEqual(set(scheduler._hosts), {'limited', 'last'})
+        self.assertEqual(10 ** 6, scheduler.host_rate('host0'))
@@ -0,0 +1,104 @@
+import gc
+import shutil
+import tempfile
+import weakref
+from unittest import TestCase
+
+from asswecan.barrages.barrage import *
+from asswecan.barrages.bilibili import BiliBarrage
+
+
+class FakeBarrage(Barrage):
+    __slots__ = ()
+
+    @classmethod
+    def from_info(cls, bid: str, out_dir: str = os.curdir):
+        return cls(bid, 'http://localhost/{}.xml'.format(bid), 'title_' + bid, out_dir)
+
+    def filename(self) -> str:
+        return self.title + '.xml'
+
+    def retrieve_content(self) -> str:
+        return '<i>{}</i>'.format(self.bid)
+
+    def to_ass(self) -> str:
+        return self.content.upper()
+
+
+class FakeTaskManager(BarrageTaskManager):
+    def __init__(self, bids, **kwargs):
+        super().__init__(show_bar=False, **kwargs)
+        self._bids = bids
+        self.processed = []
+        self.refs = []
+
+    def process_url(self, url: str) -> Iterator[Barrage]:
+        for bid in self._bids:
+            brg = FakeBarrage.from_info(bid, self._out_dir)
+            self.refs.append(weakref.ref(brg))
+            yield brg
+
+    def process_file(self, file: str) -> Barrage:
+        return FakeBarrage.from_file(file, self._out_dir)
+
+    def process_barrage(self, brg: Barrage):
+        super().process_barrage(brg)
+        self.processed.append(brg.bid)
+
+
+class TestBarrage(TestCase):
+    def setUp(self):
+        self.TEST_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_PATH)
+
+    def run_manager(self, bids, **kwargs) -> FakeTaskManager:
+        manager = FakeTaskManager(bids, out_dir=self.TEST_PATH, **kwargs)
+        manager.add_tasks('http://localhost/list', 'http://localhost/list')
+        manager.start()
+        manager.join()
+        return manager
+
+    def test_slots(self):
+        for brg in (FakeBarrage.from_info('1'), BiliBarrage.from_info('1', 'title')):
+            self.assertFalse(hasattr(brg, '__dict__'))
+        self.assertEqual('FakeBarrage:bid:1', FakeBarrage.from_info('1').key)
+        self.assertEqual('FakeBarrage:file:a.xml', FakeBarrage.from_file('a.xml').key)
+
+    def test_dedup_by_key(self):
+        manager = self.run_manager(['1', '2', '1', '3', '2'])
+        self.assertEqual(['1', '2', '3'], sorted(manager.processed))
+
+    def test_dedup_bloom(self):
+        manager = self.run_manager(['1', '2', '1', '3', '2'], bloom_capacity=1000)
+        self.assertEqual(['1', '2', '3'], sorted(manager.processed))
+
+    def test_no_barrage_retained(self):
+        manager = self.run_manager([str(i) for i in range(20)])
+        self.assertEqual(20, len(manager.processed))
+        gc.collect()
+        self.assertEqual([], [ref() for ref in manager.refs if ref() is not None])
+
+    def test_release(self):
+        brgs = [FakeBarrage.from_info(str(i), self.TEST_PATH) for i in range(3)]
+        manager = FakeTaskManager([], out_dir=self.TEST_PATH, low_memory=True)
+        manager.add_tasks(*brgs)
+        manager.start()
+        manager.join()
+        for brg in brgs:
+            self.assertIsNone(brg._content)
+            self.assertIsNone(brg._ass)
+            self.assertTrue(os.path.exists(brg.file))
+            # reloaded from the saved file instead of the url
+            brg.url = None
+            self.assertEqual('<i>{}</i>'.format(brg.bid), brg.content)
+
+    def test_keep_payload_by_default(self):
+        brg = FakeBarrage.from_info('1', self.TEST_PATH)
+        manager = FakeTaskManager([], out_dir=self.TEST_PATH)
+        manager.add_tasks(brg)
+        manager.start()
+        manager.join()
+        self.assertEqual('<i>1</i>', brg._content)
+        self.assertEqual('<I>1</I>', brg._ass)
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from unittest import TestCase
+
+from asswecan.barrages.ass import *
+from asswecan.barrages import bililive
+from asswecan.barrages.bililive import *
+from asswecan.websocket import OP_BINARY, accept_key, encode_frame, read_frame
+
+
+def danmaku(text: str, mode: int = 1, color: int = 0xffffff) -> bytes:
+    message = {'cmd': 'DANMU_MSG', 'info': [[0, mode, 25, color, 0, 0, 0, ''], text, [1, 'user']]}
+    return encode_packet(OP_MESSAGE, json.dumps(message).encode(), VER_RAW)
+
+
+# a captured stream: auth reply, popularity, a zlib batch and single messages
+STREAM = [
+    encode_packet(OP_AUTH_REPLY, b'{"code":0}'),
+    encode_packet(OP_HEARTBEAT_REPLY, (1234).to_bytes(4, 'big')),
+    encode_packet(OP_MESSAGE, zlib.compress(danmaku('第一条') + danmaku('second {x}') + danmaku('顶部', 5)),
+                  VER_ZLIB),
+    encode_packet(OP_MESSAGE, b'{"cmd":"SEND_GIFT","data":{}}', VER_RAW),
+    danmaku('红色', color=0xff0000),
+    danmaku('底部', 4) + danmaku('同帧'),
+]
+
+
+class ReplayServer:
+    def __init__(self, stream, interval: float = 0.05):
+        self.stream = stream
+        self.interval = interval
+        self.received = []
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        key = None
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            if line.lower().startswith('sec-websocket-key:'):
+                key = line.split(':', 1)[1].strip()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: {}\r\n\r\n'.format(accept_key(key))).encode())
+        _, _, auth = await read_frame(reader)
+        self.received.append(auth)
+        for data in self.stream:
+            writer.write(encode_frame(OP_BINARY, data, False))
+            await writer.drain()
+            await asyncio.sleep(self.interval)
+        writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.url = 'ws://127.0.0.1:{}/sub'.format(self.server.sockets[0].getsockname()[1])
+        return self
+
+    async def __aexit__(self, *args):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class TestBiliLive(TestCase):
+    def setUp(self):
+        self.TEST_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_PATH)
+
+    def test_iter_packets(self):
+        ops = [op for data in STREAM for op, _ in iter_packets(data)]
+        self.assertEqual([OP_AUTH_REPLY, OP_HEARTBEAT_REPLY] + [OP_MESSAGE] * 7, ops)
+
+    def test_iter_packets_malformed(self):
+        for data in (bytes(16), encode_packet(OP_MESSAGE, b'{}')[:-1],
+                     HEADER.pack(16, 8, VER_RAW, OP_MESSAGE, 1)):
+            with self.assertRaises(ValueError):
+                list(iter_packets(data))
+
+    def test_ass_writer_lanes(self):
+        path = os.path.join(self.TEST_PATH, 'lanes.ass')
+        writer = AssWriter(open(path, 'w'), font_size=50)
+        writer.add(1, '同时')
+        writer.add(1, '同时')
+        writer.add(1, 'top', MODE_TOP)
+        writer.add(20, '稍后')
+        self.assertEqual(4, writer.pending)
+        writer.close()
+        with open(path) as f:
+            events = [line for line in f if line.startswith('Dialogue')]
+        self.assertIn('\\move(1920,0,-100,0)', events[0])
+        self.assertIn('\\move(1920,50,-100,50)', events[1])
+        self.assertIn('\\an8\\pos(960,0)', events[2])
+        self.assertIn('0:00:20.00,0:00:28.00', events[3])
+        self.assertIn('\\move(1920,0,', events[3])
+
+    def test_live_recorder(self):
+        async def record():
+            async with ReplayServer(STREAM) as server:
+                recorder = BiliLiveRecorder(1000, self.TEST_PATH, url=server.url, flush_interval=0.05,
+                                            reconnect_delay=None, resolve=False)
+                ass_file = await recorder.run()
+                return server, recorder, ass_file
+
+        server, recorder, ass_file = asyncio.run(record())
+        self.assertEqual(1000, json.loads(server.received[0][HEADER.size:])['roomid'])
+        self.assertEqual(6, recorder.count)
+        with open(ass_file) as f:
+            events = [line for line in f if line.startswith('Dialogue')]
+        self.assertEqual(6, len(events))
+        self.assertTrue(events[1].endswith('second \\{x\\}\n'))
+        self.assertIn('\\c&H0000FF&}红色', events[3])
+        self.assertIn('\\an2', events[4])
+
+    def test_live_recorder_corrupt_frames(self):
+        corrupt = [
+            STREAM[0],
+            encode_packet(OP_MESSAGE, b'not zlib at all', VER_ZLIB),
+            danmaku('之后') + b'\x00\x00\x00\x01' + bytes(12),
+            bytes(16),
+            danmaku('还在'),
+        ]
+
+        async def record():
+            async with ReplayServer(corrupt) as server:
+                recorder = BiliLiveRecorder(1000, self.TEST_PATH, url=server.url, reconnect_delay=None,
+                                            resolve=False)
+                await recorder.run()
+                return recorder
+
+        recorder = asyncio.run(record())
+        self.assertEqual(2, recorder.count)
+
+    def test_live_recorder_resolve(self):
+        async def record():
+            async with ReplayServer(STREAM[:1]) as server:
+                recorder = BiliLiveRecorder(1, self.TEST_PATH, url=server.url, reconnect_delay=None)
+                await recorder.run()
+                return server
+
+        resolve = bililive.real_room_id
+        bililive.real_room_id = lambda room_id: room_id + 5000
+        try:
+            server = asyncio.run(record())
+        finally:
+            bililive.real_room_id = resolve
+        self.assertEqual(5001, json.loads(server.received[0][HEADER.size:])['roomid'])
+
+    def test_live_recorder_stop(self):
+        async def record():
+            async with ReplayServer(STREAM * 100, 0.1) as server:
+                recorder = BiliLiveRecorder(1000, self.TEST_PATH, url=server.url, flush_interval=0.05,
+                                            resolve=False)
+                asyncio.get_running_loop().call_later(0.5, recorder.stop)
+                await asyncio.wait_for(recorder.run(), 2)
+                return recorder
+
+        recorder = asyncio.run(record())
+        self.assertLess(recorder.count, 20)
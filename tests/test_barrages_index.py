@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from asswecan.barrages.bilibili import BiliTaskManager
+from asswecan.barrages.index import *
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver><chatid>{}</chatid>
+{}
+</i>'''
+
+D = '<d p="{},1,25,16777215,1536000000,0,{},0">{}</d>'
+
+
+def write_xml(path: str, bid: str, comments) -> str:
+    with open(path, 'w') as f:
+        f.write(XML.format(bid, '\n'.join(D.format(t, user, text) for t, user, text in comments)))
+    return path
+
+
+class TestBarrageIndex(TestCase):
+    def setUp(self):
+        self.TEST_PATH = tempfile.mkdtemp()
+        self.up1 = os.path.join(self.TEST_PATH, 'up1')
+        self.up2 = os.path.join(self.TEST_PATH, 'up2')
+        os.makedirs(self.up1)
+        os.makedirs(self.up2)
+        write_xml(os.path.join(self.up1, 'a.xml'), '1', [
+            (1.5, 'aaaa', '前方高能'), (30, 'bbbb', '高能预警'), (65.2, 'aaaa', 'Hello World &amp; 你好'),
+        ])
+        write_xml(os.path.join(self.up2, 'b.xml'), '2', [
+            (3, 'cccc', '前方高能!!'), (4, 'aaaa', '能'), (5, 'dddd', '前方 高能'),
+        ])
+        self.index = BarrageIndex(os.path.join(self.TEST_PATH, 'index.db'))
+        self.assertEqual(2, self.index.update(self.TEST_PATH))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.TEST_PATH)
+
+    def test_phrase(self):
+        self.assertEqual(['前方高能', '前方高能!!'], [h.text for h in self.index.search('前方高能')])
+        self.assertEqual([('1', 1.5), ('1', 30), ('2', 3), ('2', 5)], [(h.bid, h.time) for h in self.index.search('高能')])
+        self.assertEqual(['Hello World & 你好'], [h.text for h in self.index.search('hello world')])
+        self.assertEqual(5, len(self.index.search('能')))
+        self.assertEqual([], self.index.search('不存在'))
+
+    def test_filters(self):
+        self.assertEqual(3, len(self.index.search(user='aaaa')))
+        self.assertEqual(['前方高能'], [h.text for h in self.index.search('高能', user='aaaa')])
+        self.assertEqual([30, 65.2], [h.time for h in self.index.search(start=10, end=100)])
+        self.assertEqual(['前方高能!!', '前方 高能'], [h.text for h in self.index.search('前方', path_prefix=self.up2)])
+        self.assertEqual(3, len(self.index.search(bid='2')))
+
+    def test_incremental(self):
+        self.assertEqual(0, self.index.update(self.TEST_PATH))
+        time.sleep(0.01)
+        write_xml(os.path.join(self.up1, 'a.xml'), '1', [(2, 'eeee', '改了')])
+        self.assertEqual(1, self.index.update(self.TEST_PATH))
+        self.assertEqual([], self.index.search('前方高能', bid='1'))
+        self.assertEqual(['改了'], [h.text for h in self.index.search('改')])
+        self.assertEqual(4, self.index.num_comments)
+        self.index.remove_file(os.path.join(self.up2, 'b.xml'))
+        self.assertEqual(1, self.index.num_files)
+        self.assertEqual([], self.index.search('高能'))
+
+    def test_concurrent_add_file(self):
+        path = write_xml(os.path.join(self.up1, 'same.xml'), '4', [(1, 'gggg', '同名')])
+        errors = []
+
+        def add():
+            try:
+                self.index.add_file(path)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=add) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(3, self.index.num_files)
+        self.assertEqual(1, len(self.index.search('同名')))
+
+    def test_task_manager(self):
+        out_dir = os.path.join(self.TEST_PATH, 'out')
+        source = write_xml(os.path.join(self.TEST_PATH, 'c.xml'), '3', [(7, 'ffff', '新的弹幕')])
+        manager = BiliTaskManager(out_dir, convert=False, show_bar=False, index=self.index)
+        manager.add_tasks(source)
+        manager.start()
+        manager.join()
+        self.assertEqual([os.path.join(out_dir, 'c.xml')], [h.file for h in self.index.search('新的弹幕')])
@@ -1,9 +1,176 @@
 import hashlib
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
 
+from asswecan import net
+from asswecan.bandwidth import bandwidth_scheduler
+from asswecan.barrages.barrage import BarrageTaskManager
 from asswecan.net import *
 
 
+class LocalHandler(BaseHTTPRequestHandler):
+    DATA = bytes(range(256)) * 4096
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers['Range']))
+        if self.path.startswith('/slow/'):
+            if self.path == '/slow/always' or len(self.requests) == 1:
+                time.sleep(2)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write('慢'.encode())
+            return
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', '/files/' + self.path.rsplit('/', 1)[1])
+            self.end_headers()
+            return
+        data, start = self.DATA, 0
+        m = re.match(r'bytes=(\d+)-$', self.headers['Range'] or '')
+        if m:
+            start = int(m.group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLocalNet(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.URL = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        LocalHandler.requests.clear()
+        self.TEST_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_PATH)
+
+    def test_url_save_single_request(self):
+        file, size = url_save(self.URL + '/files/a.bin', out_dir=self.TEST_PATH)
+        self.assertEqual((os.path.join(self.TEST_PATH, 'a.bin'), len(LocalHandler.DATA)), (file, size))
+        self.assertEqual([('/files/a.bin', None)], LocalHandler.requests)
+
+    def test_url_save_resume(self):
+        with open(os.path.join(self.TEST_PATH, 'b.bin.part'), 'wb') as f:
+            f.write(LocalHandler.DATA[:1000])
+        file, size = url_save(self.URL + '/files/b.bin', out_dir=self.TEST_PATH, filename='b.bin')
+        self.assertEqual(len(LocalHandler.DATA), size)
+        self.assertEqual([('/files/b.bin', 'bytes=1000-')], LocalHandler.requests)
+        with open(file, 'rb') as f:
+            self.assertEqual(LocalHandler.DATA, f.read())
+
+    def test_url_save_resume_complete_part(self):
+        with open(os.path.join(self.TEST_PATH, 'b.bin.part'), 'wb') as f:
+            f.write(LocalHandler.DATA)
+        file, size = url_save(self.URL + '/files/b.bin', out_dir=self.TEST_PATH, filename='b.bin')
+        self.assertEqual(len(LocalHandler.DATA), size)
+        # the unsatisfiable range is not retried before falling back to a full request
+        self.assertEqual([('/files/b.bin', 'bytes={}-'.format(len(LocalHandler.DATA))), ('/files/b.bin', None)],
+                         LocalHandler.requests)
+        with open(file, 'rb') as f:
+            self.assertEqual(LocalHandler.DATA, f.read())
+
+    def test_url_save_redirect_cached(self):
+        session = DownloadSession()
+        session.save(self.URL + '/redirect/c.bin', out_dir=self.TEST_PATH, force=True)
+        session.save(self.URL + '/redirect/c.bin', out_dir=self.TEST_PATH, force=True)
+        self.assertEqual(['/redirect/c.bin', '/files/c.bin', '/files/c.bin'], [r[0] for r in LocalHandler.requests])
+
+    def test_url_save_many(self):
+        urls = [self.URL + '/files/d.bin'] * 2 + [self.URL + '/files/{}.bin'.format(i) for i in range(8)]
+        results = url_save_many(urls, out_dir=self.TEST_PATH, num_threads=3)
+        self.assertEqual(len(urls), len(results))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(9, len({file for file, _ in results}))
+        self.assertEqual(9, len(LocalHandler.requests))
+
+    def test_url_save_many_same_name(self):
+        urls = [self.URL + '/files/e.bin?{}'.format(i) for i in range(4)]
+        results = url_save_many(urls, out_dir=self.TEST_PATH, num_threads=4)
+        self.assertEqual(4, len({file for file, _ in results}))
+        for file, size in results:
+            self.assertEqual(len(LocalHandler.DATA), os.path.getsize(file))
+
+    def test_url_save_throttled(self):
+        scheduler = bandwidth_scheduler()
+        scheduler.set_rate(512 * 1024)
+        try:
+            begin = time.monotonic()
+            url_save(self.URL + '/files/f.bin', out_dir=self.TEST_PATH)
+            self.assertAlmostEqual(1, time.monotonic() - begin, delta=0.4)
+        finally:
+            scheduler.set_rate(None)
+
+    def test_url_get_content_hedge(self):
+        delay = net.HEDGE_DEFAULT_DELAY
+        net.HEDGE_DEFAULT_DELAY = 0.2
+        try:
+            begin = time.monotonic()
+            self.assertEqual('慢', url_get_content(self.URL + '/slow/once', hedge=95))
+            self.assertLess(time.monotonic() - begin, 1.5)
+            self.assertEqual(2, len(LocalHandler.requests))
+        finally:
+            net.HEDGE_DEFAULT_DELAY = delay
+
+    def test_url_get_content_deadline(self):
+        begin = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            url_get_content(self.URL + '/slow/always', deadline=Deadline(0.3))
+        self.assertLess(time.monotonic() - begin, 1.5)
+
+    def test_deadline_scope_cancel(self):
+        deadline = Deadline()
+        threading.Timer(0.2, deadline.cancel).start()
+        begin = time.monotonic()
+        with deadline_scope(deadline), self.assertRaises(DeadlineExceeded):
+            url_get_content(self.URL + '/slow/always')
+        self.assertLess(time.monotonic() - begin, 1.5)
+
+    def test_barrage_task_manager_cancel(self):
+        url = self.URL + '/slow/always'
+
+        class SlowManager(BarrageTaskManager):
+            def process_url(self, item):
+                url_get_content(url)
+                return iter(())
+
+            def process_file(self, file):
+                raise NotImplementedError
+
+        manager = SlowManager(self.TEST_PATH, num_threads=2, show_bar=False)
+        manager.add_tasks(*['{}?{}'.format(url, i) for i in range(6)])
+        manager.start()
+        time.sleep(0.2)
+        begin = time.monotonic()
+        with self.assertNoLogs(level='ERROR'):
+            manager.cancel()
+            manager.join()
+        self.assertLess(time.monotonic() - begin, 1)
+
+
 class TestNet(TestCase):
     URL_MD5 = 'https://cdimage.debian.org/debian-cd/current/amd64/iso-cd/MD5SUMS'
     URL_IMG = 'https://cdimage.debian.org/debian-cd/current/amd64/iso-cd/debian-9.5.0-amd64-netinst.iso'
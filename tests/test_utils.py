@@ -56,3 +56,33 @@ class TestUtils(TestCase):
         print('{} tasks added, waiting for processing'.format(d.num_tasks))
         d.join()
         print('all tasks done')
+
+    def test_multi_task_manager_cancel(self):
+        done = []
+
+        class SleepManager(MultiTaskManager):
+            def add_tasks(self, *items: int):
+                for item in items:
+                    self._queue.put(item)
+
+            def _start_task(self, item: int):
+                time.sleep(0.2)
+                done.append(item)
+
+        d = SleepManager(2)
+        d.add_tasks(*range(20))
+        d.start()
+        time.sleep(0.1)
+        d.cancel()
+        d.join()
+        self.assertEqual(2, len(done))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('BiliBarrage:bid:{}'.format(i))
+        for i in range(1000):
+            self.assertIn('BiliBarrage:bid:{}'.format(i), bloom)
+        false_positives = sum('BiliBarrage:bid:{}'.format(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 200)
+        self.assertGreater(len(bloom), 990)